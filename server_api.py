@@ -1,31 +1,43 @@
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse
-from typing import List
+from typing import List, Optional
 from pathlib import Path
-import shutil
-import subprocess
-import sys
-import time
 import os
+import time
+
+import aiofiles
+
+from Face_Recognition_System import FaceRecognitionSystem, format_results
 
 app = FastAPI(title="Face Recognition API")
 
 BASE_DIR = Path(__file__).resolve().parent
 RAW_DIR = BASE_DIR / "RawImages"
 PAIRS_DIR = BASE_DIR / "pairs"
-RESULTS_FILE = BASE_DIR / "results.txt"
-PYTHON_EXECUTABLE = os.environ.get("PYTHON_EXECUTABLE") or sys.executable
 
 PAIRS_DIR.mkdir(parents=True, exist_ok=True)
 
 app.mount("/pairs", StaticFiles(directory=str(PAIRS_DIR)), name="pairs")
 
+# Loaded once at startup so requests pay only inference time, not model
+# load + CUDA initialization.
+SYSTEM: Optional[FaceRecognitionSystem] = None
+
+
+@app.on_event("startup")
+def load_models() -> None:
+    global SYSTEM
+    SYSTEM = FaceRecognitionSystem()
+
+
 def clear_raw_images() -> None:
     if RAW_DIR.exists():
-        for item in RAW_DIR.iterdir():
-            if item.is_file():
-                item.unlink()
+        # scandir's DirEntry caches the file type, avoiding a stat per entry.
+        with os.scandir(RAW_DIR) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    os.unlink(entry.path)
     else:
         RAW_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -47,49 +59,30 @@ async def compare_faces(
         for upload in images:
             filename = f"{int(time.time() * 1000)}_{upload.filename}"
             destination = RAW_DIR / filename
-            with destination.open("wb") as buffer:
-                shutil.copyfileobj(upload.file, buffer)
-
-        result = subprocess.run(
-            [
-                PYTHON_EXECUTABLE,
-                "Face_Recognition_System.py",
-                "--input-dir",
-                str(RAW_DIR),
-                "--output-dir",
-                str(PAIRS_DIR),
-                "--threshold",
-                str(threshold),
-                "--results-file",
-                str(RESULTS_FILE),
-            ],
-            cwd=str(BASE_DIR),
-            capture_output=True,
-            text=True,
-        )
+            # Write asynchronously in 1 MiB chunks so large uploads do
+            # not block the event loop the way copyfileobj did.
+            async with aiofiles.open(destination, "wb") as buffer:
+                while chunk := await upload.read(1 << 20):
+                    await buffer.write(chunk)
 
-        if result.returncode != 0:
+        faces = SYSTEM.crop_faces_from_directory(str(RAW_DIR), str(PAIRS_DIR))
+
+        if len(faces) < 2:
             return JSONResponse(
                 status_code=500,
                 content={
                     "success": False,
-                    "error": result.stderr.strip() or "Face recognition failed.",
-                    "output": result.stdout,
+                    "error": "Fewer than two faces detected in the uploaded images.",
                 },
             )
 
-        if not RESULTS_FILE.exists():
-            return JSONResponse(
-                status_code=500,
-                content={"success": False, "error": "Results file not found."},
-            )
-
-        results_text = RESULTS_FILE.read_text(encoding="utf-8")
+        results = SYSTEM.compare_all_pairs(faces, threshold)
+        results_text = format_results(results)
 
         return {
             "success": True,
             "results": results_text,
-            "output": result.stdout,
+            "output": f"Cropped {len(faces)} faces.",
         }
     except Exception as exc:
         return JSONResponse(
@@ -106,4 +99,4 @@ async def clear_images():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "ok", "python": PYTHON_EXECUTABLE}
+    return {"status": "ok", "models_loaded": SYSTEM is not None}